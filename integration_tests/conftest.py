@@ -1,33 +1,126 @@
+import hashlib
 import json
+import os
+import shutil
 import subprocess
+import tempfile
 from pathlib import Path
 
 import pytest
 
-from .utils import Command, wait_for_port
+from .utils import Command, interact, wait_for_port
 
 
-@pytest.fixture(scope="session")
-def cluster(tmp_path_factory):
-    data = tmp_path_factory.mktemp("data")
-    base_port = 10000
-    config = Path(__file__).parent / "config.yaml"
-    with subprocess.Popen(
-        f"pystarport serve --config {config} --data {data} --base_port {base_port} "
-        "--quiet",
-        shell=True,
-    ) as proc:
+def init_data(cache_root, config, base_port):
+    """
+    `pystarport init` (genesis and validators setup) is the slowest part of the
+    startup, cache the initialized data directory in `cache_root`, keyed by the
+    config and the wasmd and pystarport binaries.
+    """
+    # nix builds wasmd without version ldflags, the resolved store paths and the
+    # mtime identify the binaries
+    wasmd = Path(shutil.which("wasmd")).resolve()
+    pystarport = Path(shutil.which("pystarport")).resolve()
+    key = hashlib.sha256(
+        b"\0".join(
+            [
+                config.read_bytes(),
+                str(base_port).encode(),
+                str(wasmd).encode(),
+                str(wasmd.stat().st_mtime_ns).encode(),
+                interact([str(wasmd), "version", "--long"]),
+                str(pystarport).encode(),
+            ]
+        )
+    ).hexdigest()[:16]
+    # prune the entries of old configs and binaries
+    for entry in cache_root.iterdir():
+        if not entry.name.startswith(key):
+            shutil.rmtree(entry, ignore_errors=True)
+    cache = cache_root / key
+    if not cache.exists():
+        tmp = cache.with_name(f"{key}.{os.getpid()}")
         try:
-            print("start in path:", data, "base port:", base_port)
-            print("wait for rpc of first node to be ready")
-            wait_for_port(10007, timeout=10)
-            wasmd = Command(
-                "wasmd",
-                data / "chainmaind" / "node0",
-                "tcp://localhost:10007",
-                "chainmaind",
+            interact(
+                [
+                    "pystarport",
+                    "init",
+                    "--config",
+                    str(config),
+                    "--data",
+                    str(tmp),
+                    "--base_port",
+                    str(base_port),
+                ]
             )
-            wasmd.wait_for_block(1)
-            yield wasmd
+            tmp.rename(cache)
+        except OSError:
+            # initialized concurrently by another session
+            if not cache.exists():
+                raise
         finally:
-            proc.terminate()
+            shutil.rmtree(tmp, ignore_errors=True)
+    return cache
+
+
+@pytest.fixture(scope="session")
+def cluster(request, tmp_path_factory):
+    # on tmpfs if available, so the nodes don't fsync every block to disk
+    shm = Path("/dev/shm")
+    data = Path(tempfile.mkdtemp(prefix="data", dir=shm if shm.is_dir() else None))
+    base_port = 10000
+    config = Path(__file__).parent / "config.yaml"
+    # user owned, under .pytest_cache (`makedir`, pytest is pinned to 6.2)
+    cache_root = Path(request.config.cache.makedir("pystarport"))
+    try:
+        shutil.copytree(
+            init_data(cache_root, config, base_port), data, dirs_exist_ok=True
+        )
+        # node logs are written to the data directory by supervisord
+        with subprocess.Popen(
+            ["pystarport", "start", "--data", str(data), "--quiet"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        ) as proc:
+            try:
+                print("start in path:", data, "base port:", base_port)
+                wasmd = Command(
+                    "wasmd",
+                    data / "chainmaind" / "node0",
+                    "tcp://localhost:10007",
+                    "chainmaind",
+                )
+                # rpc of first node, the cli queries fail until it's up
+                wait_for_port(10007, timeout=20)
+                wasmd.wait_for_block(1, timeout=20)
+                yield wasmd
+            finally:
+                proc.terminate()
+    finally:
+        # keep only the logs, pytest prunes the old basetemps
+        logs = tmp_path_factory.mktemp("logs")
+        for log in data.rglob("*.log"):
+            dst = logs / log.relative_to(data)
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(log, dst)
+        print("node logs in path:", logs)
+        shutil.rmtree(data, ignore_errors=True)
+
+
+@pytest.fixture(scope="session")
+def cw20_bonding_code_id(cluster):
+    "store the code once, tests only instantiate it"
+    return cluster.store(
+        Path(__file__).parent / "artifacts/cw20_bonding.wasm",
+        cluster.address("community"),
+    )
+
+
+@pytest.fixture(scope="session")
+def subscription_code_id(cluster):
+    "store the code once, tests only instantiate it"
+    return cluster.store(
+        Path(__file__).parent
+        / "../target/wasm32-unknown-unknown/release/cw_subscription.wasm",
+        cluster.address("community"),
+    )
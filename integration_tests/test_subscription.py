@@ -1,8 +1,11 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
-from pathlib import Path
 
 from .test_wrap_contract import WRAP_TOKEN
 
+# seconds between the latest block and the block including the subscribe tx
+SUBSCRIBE_MARGIN = 5
+
 
 def round_up_minute(t):
     return t + (60 - t % 60)
@@ -12,28 +15,35 @@ def round_down_minute(t):
     return t - t % 60
 
 
-def test_subscription(cluster):
+def test_subscription(cluster, cw20_bonding_code_id, subscription_code_id):
     creator = cluster.address("community")
     user = cluster.address("ecosystem")
-    print("deploy cw20 and subscription contracts")
-    cw20_contract = cluster.construct(
-        Path(__file__).parent / "artifacts/cw20_bonding.wasm",
-        WRAP_TOKEN,
-        creator,
-        label="wcosm",
-    )
-    contract = cluster.construct(
-        Path(__file__).parent
-        / "../target/wasm32-unknown-unknown/release/cw_subscription.wasm",
-        {
-            "params": {
-                "required_deposit_plan": [{"amount": "1000", "denom": "ucosm"}],
-                "required_deposit_subscription": [{"amount": "1000", "denom": "ucosm"}],
+    print("instantiate cw20 and subscription contracts")
+    # different senders, so the two txs don't race on the account sequence
+    with ThreadPoolExecutor(2) as executor:
+        cw20_future = executor.submit(
+            cluster.instantiate,
+            cw20_bonding_code_id,
+            WRAP_TOKEN,
+            user,
+            label="wcosm",
+        )
+        contract_future = executor.submit(
+            cluster.instantiate,
+            subscription_code_id,
+            {
+                "params": {
+                    "required_deposit_plan": [{"amount": "1000", "denom": "ucosm"}],
+                    "required_deposit_subscription": [
+                        {"amount": "1000", "denom": "ucosm"}
+                    ],
+                },
             },
-        },
-        creator,
-        label="subscription",
-    )
+            creator,
+            label="subscription",
+        )
+        cw20_contract = cw20_future.result()
+        contract = contract_future.result()
     # ./target/debug/examples/cron "* * * * *"
     cron = {
         "minute": 1152921504606846975,
@@ -42,8 +52,10 @@ def test_subscription(cluster):
         "month": 8190,
         "wday": 127,
     }
-    print("create per-minute subscription plan")
-    events = cluster.execute(
+    print("create per-minute subscription plan, deposit cw20 tokens and set approval")
+    # independent txs from different senders, don't wait for create_plan to be
+    # committed while the batch tx is being built and broadcast
+    plan_tx = cluster.execute_nowait(
         contract,
         {
             "create_plan": {
@@ -58,10 +70,32 @@ def test_subscription(cluster):
         creator,
         amount=1000,
     )
+    # buy and approval in a single tx
+    _ = cluster.execute_batch(
+        [
+            (cw20_contract, {"buy": {}}, 1000000),
+            (
+                cw20_contract,
+                {
+                    "increase_allowance": {
+                        "spender": contract,
+                        "amount": "1000000",
+                    },
+                },
+                0,
+            ),
+        ],
+        user,
+    )
+    events = cluster.wait_for_tx(plan_tx)
     plan_id = int(events[2]["plan_id"])
 
     print("subscribe")
-    next_collection_time = round_up_minute(int(datetime.now().timestamp()))
+    # the contract rejects it unless it's after the time of the block including the
+    # subscribe tx, which is later than the latest block, leave a margin
+    next_collection_time = round_up_minute(
+        int(cluster.block_time().timestamp()) + SUBSCRIBE_MARGIN
+    )
     events = cluster.execute(
         contract,
         {
@@ -90,26 +124,6 @@ def test_subscription(cluster):
     print("subscriptions", rsp)
     assert len(rsp["subscriptions"]) == 1
 
-    print("deposit cw20 tokens and set approval")
-    _ = cluster.execute(
-        cw20_contract,
-        {
-            "buy": {},
-        },
-        user,
-        amount=1000000,
-    )
-    cluster.execute(
-        cw20_contract,
-        {
-            "increase_allowance": {
-                "spender": contract,
-                "amount": "1000000",
-            },
-        },
-        user,
-    )
-
     print("collect payments")
     events = cluster.execute(
         contract,
@@ -1,5 +1,3 @@
-from pathlib import Path
-
 WRAP_TOKEN = {
     "name": "wrapped cosm",
     "symbol": "wcosm",
@@ -12,14 +10,14 @@ WRAP_TOKEN = {
 }
 
 
-def test_wrap_contract(cluster):
+def test_wrap_contract(cluster, cw20_bonding_code_id):
     """
     test cw20 contract that wrap native token
     use the cw20-bonding example contract in cosmwasm-plus repo.
     """
     creator = cluster.address("community")
-    contract = cluster.construct(
-        Path(__file__).parent / "artifacts/cw20_bonding.wasm",
+    contract = cluster.instantiate(
+        cw20_bonding_code_id,
         WRAP_TOKEN,
         creator,
         label="wcosm",
@@ -1,54 +1,54 @@
-import configparser
+import base64
+import functools
+import http.client
 import json
+import os
 import socket
 import subprocess
+import tempfile
+import threading
 import time
-
-from dateutil.parser import isoparse
-
-
-def interact(cmd, ignore_error=False, input=None, **kwargs):
-    proc = subprocess.Popen(
-        cmd,
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        shell=True,
+from datetime import datetime
+from pathlib import Path
+from urllib.parse import urlparse
+
+# status is a cheap request on the rpc connection, poll well within block time
+POLL_INTERVAL = 0.1
+
+
+def interact(argv, ignore_error=False, input=None, capture=True, **kwargs):
+    """
+    run the command, returns the stdout (merged with stderr),
+    with `capture=False` the stdout is discarded and only stderr is kept for errors.
+    """
+    proc = subprocess.run(
+        argv,
+        # never let the cli wait on the terminal for input
+        input=b"" if input is None else input,
+        stdout=subprocess.PIPE if capture else subprocess.DEVNULL,
+        stderr=subprocess.STDOUT if capture else subprocess.PIPE,
         **kwargs,
     )
-    # begin = time.perf_counter()
-    (stdout, _) = proc.communicate(input=input)
-    # print('[%.02f] %s' % (time.perf_counter() - begin, cmd))
     if not ignore_error:
-        assert proc.returncode == 0, f'{stdout.decode("utf-8")} ({cmd})'
-    return stdout
-
-
-def write_ini(fp, cfg):
-    ini = configparser.RawConfigParser()
-    for section, items in cfg.items():
-        ini.add_section(section)
-        sec = ini[section]
-        sec.update(items)
-    ini.write(fp)
+        output = proc.stdout if capture else proc.stderr
+        assert proc.returncode == 0, f'{output.decode("utf-8")} ({argv})'
+    return proc.stdout
 
 
-def safe_cli_string(s):
-    'wrap string in "", used for cli argument when contains spaces'
-    s = str(s)
-    if len(s.split()) > 1:
-        return f"'{s}'"
-    return s
+def dumps(obj):
+    "compact json, the contracts parse (and pay gas for) every byte of the msg"
+    return json.dumps(obj, separators=(",", ":"))
 
 
-def build_cli_args_safe(*args, **kwargs):
-    args = [safe_cli_string(arg) for arg in args if arg]
-    for k, v in kwargs.items():
-        if v is None:
-            continue
-        args.append("--" + k.strip("_").replace("_", "-"))
-        args.append(safe_cli_string(v))
-    return list(map(str, args))
+def write_ini(fp, cfg):
+    fp.write(
+        "".join(
+            f"[{section}]\n"
+            + "".join(f"{key} = {value}\n" for key, value in items.items())
+            + "\n"
+            for section, items in cfg.items()
+        )
+    )
 
 
 def build_cli_args(*args, **kwargs):
@@ -69,14 +69,76 @@ def format_doc_string(**kwargs):
     return decorator
 
 
+class RpcClient:
+    """
+    tendermint json-rpc client over persistent http connections (one per thread),
+    avoid spawning the cli for read-only queries.
+    """
+
+    def __init__(self, node, timeout=10):
+        url = urlparse(node)
+        self._host = url.hostname
+        self._port = url.port
+        self._timeout = timeout
+        self._local = threading.local()
+
+    @property
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = http.client.HTTPConnection(
+                self._host, self._port, timeout=self._timeout
+            )
+        return conn
+
+    def call(self, method, **params):
+        body = dumps({"jsonrpc": "2.0", "id": 0, "method": method, "params": params})
+        conn = self._conn
+        while True:
+            reused = conn.sock is not None
+            try:
+                conn.request("POST", "/", body, {"Content-Type": "application/json"})
+                rsp = json.loads(conn.getresponse().read())
+                break
+            except (
+                http.client.RemoteDisconnected,
+                BrokenPipeError,
+                ConnectionResetError,
+            ):
+                conn.close()
+                if not reused:
+                    raise
+                # the server closed the idle keep-alive connection, retry once on
+                # a fresh one
+            except (http.client.HTTPException, OSError):
+                # reconnect on the next call
+                conn.close()
+                raise
+        if "error" in rsp:
+            raise RuntimeError(f"rpc {method} failed: {rsp['error']}")
+        return rsp["result"]
+
+    def status(self):
+        return self.call("status")
+
+    def abci_query(self, path, data=b""):
+        rsp = self.call("abci_query", path=path, data=data.hex())["response"]
+        assert rsp["code"] == 0, rsp["log"]
+        return base64.b64decode(rsp["value"] or "")
+
+
 class Command:
     def __init__(self, cmd, home, node, chain_id):
         self.cmd = cmd
         self.home = home
         self.node = node
         self.chain_id = chain_id
+        # set USE_CLI=1 to route queries through the cli as well
+        self.rpc = None if os.environ.get("USE_CLI") else RpcClient(node)
+        # keyring doesn't change during the session
+        self._addr_cache = {}
 
-    def __call__(self, cmd, *args, stdin=None, **kwargs):
+    def __call__(self, cmd, *args, stdin=None, capture=True, **kwargs):
         "execute command"
         kwargs.setdefault("home", self.home)
         if cmd in ("tx", "status", "query"):
@@ -87,50 +149,80 @@ class Command:
             kwargs.setdefault("keyring_backend", "test")
         if cmd in ("query",):
             kwargs.setdefault("output", "json")
-        args = " ".join(build_cli_args_safe(cmd, *args, **kwargs))
-        return interact(f"{self.cmd} {args}", input=stdin)
+        argv = [self.cmd, *build_cli_args(cmd, *args, **kwargs)]
+        return interact(argv, input=stdin, capture=capture)
+
+    def call_noout(self, cmd, *args, **kwargs):
+        "execute command, discard the output"
+        self(cmd, *args, capture=False, **kwargs)
 
     def wait_for_block(self, n, timeout=10):
         print("wait for block", n)
-        for i in range(timeout):
-            height = int(self.status()["SyncInfo"]["latest_block_height"])
-            print("current block", height)
+        deadline = time.perf_counter() + timeout
+        last_err = None
+        while True:
+            try:
+                height = self.block_height()
+            except (ConnectionRefusedError, ConnectionResetError) as ex:
+                # rpc server is still starting
+                last_err = ex
+                height = 0
             if height >= n:
+                print("current block", height)
                 break
-            time.sleep(1)
-        else:
-            raise TimeoutError(f"wait for block {n}")
+            if time.perf_counter() >= deadline:
+                raise TimeoutError(f"wait for block {n}") from last_err
+            time.sleep(POLL_INTERVAL)
 
     def wait_for_new_blocks(self, n):
-        begin_height = int((self.status())["SyncInfo"]["latest_block_height"])
-        while True:
-            time.sleep(0.5)
-            cur_height = int((self.status())["SyncInfo"]["latest_block_height"])
-            if cur_height - begin_height >= n:
-                break
+        begin_height = self.block_height()
+        while self.block_height() - begin_height < n:
+            time.sleep(POLL_INTERVAL)
 
     def wait_for_block_time(self, t):
         print("wait for block time", t)
         while True:
-            now = isoparse(json.loads(self("status"))["SyncInfo"]["latest_block_time"])
-            print("block time now:", now)
+            now = self.block_time()
             if now >= t:
+                print("block time now:", now)
                 break
-            time.sleep(0.5)
+            time.sleep(POLL_INTERVAL)
+
+    def block_height(self):
+        return int(self.status()["SyncInfo"]["latest_block_height"])
+
+    def block_time(self):
+        return parse_block_time(self.status()["SyncInfo"]["latest_block_time"])
 
     def status(self):
-        return json.loads(self("status"))
+        if self.rpc is None:
+            return json.loads(self("status"))
+        rsp = self.rpc.status()
+        # same layout as the cli output
+        return {
+            "NodeInfo": rsp["node_info"],
+            "SyncInfo": rsp["sync_info"],
+            "ValidatorInfo": rsp["validator_info"],
+        }
 
     def address(self, name):
-        return self("keys", "show", name, "-a").strip().decode()
+        if name not in self._addr_cache:
+            self._addr_cache[name] = self("keys", "show", name, "-a").strip().decode()
+        return self._addr_cache[name]
 
     def balances(self, address):
-        return {
-            balance["denom"]: int(balance["amount"])
-            for balance in json.loads(self("query", "bank", "balances", address))[
+        if self.rpc is None:
+            balances = json.loads(self("query", "bank", "balances", address))[
                 "balances"
             ]
-        }
+        else:
+            balances = json.loads(
+                self.rpc.abci_query(
+                    "custom/bank/all_balances",
+                    dumps({"address": address}).encode(),
+                )
+            )
+        return {balance["denom"]: int(balance["amount"]) for balance in balances}
 
     def store(self, path, from_, gas=2000000):
         rsp = Response(
@@ -157,7 +249,7 @@ class Command:
                     "wasm",
                     "instantiate",
                     code_id,
-                    json.dumps(init_msg),
+                    dumps(init_msg),
                     "-y",
                     label=label,
                     admin=admin or from_,
@@ -183,7 +275,7 @@ class Command:
                     "wasm",
                     "execute",
                     contract,
-                    json.dumps(msg),
+                    dumps(msg),
                     "-y",
                     from_=from_,
                     amount=f"{amount}ucosm",
@@ -193,7 +285,103 @@ class Command:
         assert rsp.code == 0, rsp["raw_log"]
         return rsp.events
 
+    def execute_batch(self, msgs, from_, gas_per_msg=200000):
+        """
+        execute several `(contract, msg, amount)` in a single tx, so they only wait
+        for one block, returns the events of each msg.
+        """
+        # generate the tx with the cli once, then append copies of its msg
+        (contract, msg, amount), *rest = msgs
+        tx = json.loads(
+            self(
+                "tx",
+                "wasm",
+                "execute",
+                contract,
+                dumps(msg),
+                "--generate-only",
+                from_=from_,
+                amount=f"{amount}ucosm",
+                gas=gas_per_msg * len(msgs),
+            )
+        )
+        messages = tx["body"]["messages"]
+        template = messages[0]
+        for contract, msg, amount in rest:
+            if isinstance(template["msg"], str):
+                # follow the encoding of the generated msg, base64 or raw json
+                msg = base64.b64encode(dumps(msg).encode()).decode()
+            funds = [{"denom": "ucosm", "amount": str(amount)}] if amount else []
+            messages.append(dict(template, contract=contract, msg=msg, funds=funds))
+        with tempfile.TemporaryDirectory() as tmp:
+            unsigned_path = Path(tmp) / "unsigned.json"
+            unsigned_path.write_text(dumps(tx))
+            signed_path = Path(tmp) / "signed.json"
+            self.call_noout(
+                "tx", "sign", unsigned_path, from_=from_, output_document=signed_path
+            )
+            rsp = Response(json.loads(self("tx", "broadcast", signed_path)))
+        assert rsp.code == 0, rsp["raw_log"]
+        return [parse_events(rsp, i) for i in range(len(msgs))]
+
+    def execute_nowait(self, contract, msg, from_, amount=0):
+        """
+        broadcast without waiting for the block, txs from different senders can
+        land in the same block, returns the tx hash to pass to `wait_for_tx`.
+        """
+        rsp = Response(
+            json.loads(
+                self(
+                    "tx",
+                    "wasm",
+                    "execute",
+                    contract,
+                    dumps(msg),
+                    "-y",
+                    from_=from_,
+                    amount=f"{amount}ucosm",
+                    broadcast_mode="sync",
+                )
+            )
+        )
+        assert rsp.code == 0, rsp["raw_log"]
+        return rsp["txhash"]
+
+    def wait_for_tx(self, txhash, timeout=10):
+        "wait for the tx to be committed, returns the events like `execute`"
+        deadline = time.perf_counter() + timeout
+        while True:
+            rsp = self.tx_result(txhash)
+            if rsp is not None:
+                break
+            if time.perf_counter() >= deadline:
+                raise TimeoutError(f"wait for tx {txhash}")
+            time.sleep(POLL_INTERVAL)
+        assert rsp.code == 0, rsp["raw_log"]
+        return rsp.events
+
+    def tx_result(self, txhash):
+        "result of committed tx, None if not found"
+        query = f"tx.hash='{txhash}'"
+        if self.rpc is None:
+            txs = json.loads(self("query", "txs", events=query.replace("'", "")))[
+                "txs"
+            ]
+            return Response(txs[0]) if txs else None
+        txs = self.rpc.call("tx_search", query=query)["txs"]
+        if not txs:
+            return None
+        result = txs[0]["tx_result"]
+        return Response(code=result["code"], raw_log=result["log"])
+
     def query(self, contract, msg):
+        if self.rpc is not None:
+            return json.loads(
+                self.rpc.abci_query(
+                    f"custom/wasm/contract-state/{contract}/smart",
+                    dumps(msg).encode(),
+                )
+            )
         return json.loads(
             self(
                 "query",
@@ -201,13 +389,13 @@ class Command:
                 "contract-state",
                 "smart",
                 contract,
-                json.dumps(msg),
+                dumps(msg),
             )
         )["data"]
 
 
 class Response(dict):
-    @property
+    @functools.cached_property
     def events(self):
         return parse_events(self)
 
@@ -231,8 +419,16 @@ def wait_for_port(port, host="127.0.0.1", timeout=40.0):
                 ) from ex
 
 
-def parse_events(rsp):
+def parse_block_time(s):
+    """
+    parse the RFC3339 utc time of tendermint, e.g. 2021-05-01T12:00:59.123456789Z,
+    truncated to seconds, `datetime.fromisoformat` can't parse nanoseconds nor "Z".
+    """
+    return datetime.fromisoformat(s[:19] + "+00:00")
+
+
+def parse_events(rsp, msg_index=0):
     return [
         {attr["key"]: attr["value"] for attr in evt["attributes"]}
-        for evt in json.loads(rsp["raw_log"])[0]["events"]
+        for evt in json.loads(rsp["raw_log"])[msg_index]["events"]
     ]